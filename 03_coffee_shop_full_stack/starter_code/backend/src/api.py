@@ -1,13 +1,37 @@
 import os
+import hashlib
 from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
-import json
+from flask.json import JSONEncoder, JSONDecoder
+from sqlalchemy import exc, select, bindparam
+import orjson
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink, create_all
+from .database.models import db_drop_and_create_all, setup_db, db, Drink, create_all, drink_short, drink_long
 from .auth.auth import AuthError, requires_auth
 
+
+class OrjsonEncoder(JSONEncoder):
+    '''Routes jsonify() and every other flask.json.dumps call through orjson'''
+
+    def encode(self, o):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode()
+
+
+class OrjsonDecoder(JSONDecoder):
+    '''Routes request.json / request.get_json() through orjson'''
+
+    def decode(self, s, _w=None):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json_encoder = OrjsonEncoder
+app.json_decoder = OrjsonDecoder
 setup_db(app)
 CORS(app)
 
@@ -18,6 +42,117 @@ CORS(app)
 '''
 # db_drop_and_create_all()
 
+# The list endpoints only need these three columns, so they select plain rows
+# instead of hydrating Drink entities into the session's identity map.
+# Built once at import so the same statement object is reused per request.
+_DRINK_ROWS = select([Drink.id, Drink.title, Drink.recipe])
+_DRINK_ROW = _DRINK_ROWS.where(Drink.id == bindparam('id'))
+
+# Compiled SQL for the two statements above. SQLAlchemy 1.3 only accepts
+# compiled_cache on a Connection, so execute_drink_rows() runs just these
+# statements on a branch of the session's connection that carries it;
+# ad-hoc ORM statements never touch (or grow) this cache.
+_drink_rows_compiled = {}
+
+
+def execute_drink_rows(statement, *params):
+    connection = db.session.connection().execution_options(compiled_cache=_drink_rows_compiled)
+    return connection.execute(statement, *params)
+
+
+# Keys a drink body and each of its recipe ingredients must carry
+_DRINK_KEYS = frozenset(('title', 'recipe'))
+_INGREDIENT_KEYS = frozenset(('name', 'color', 'parts'))
+
+
+def recipe_is_valid(recipe):
+    '''Checks a recipe is in the long format, i.e. a list of ingredients
+    that each have a name, color, and parts, in a single pass'''
+    return isinstance(recipe, list) and all(
+        isinstance(ingredient, dict) and _INGREDIENT_KEYS <= ingredient.keys()
+        for ingredient in recipe
+    )
+
+
+def read_json_body(on_error=abort):
+    '''Parses the request body with orjson. The raw bytes are read with
+    cache=False and the result isn't cached on the request the way
+    request.json is, since each body is only parsed once'''
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        on_error(400)
+
+
+def reject_drink_body(id, status):
+    '''PATCH checks its body before touching the row, so a bad body looks the
+    drink up here to still answer 404 for an unknown id ahead of status'''
+    if execute_drink_rows(_DRINK_ROW, {'id': id}).first() is None:
+        abort(404)
+    abort(status)
+
+
+# Serialized GET /drinks ('short') and /drinks-detail ('long') bodies with
+# their ETags. The menu rarely changes, so each body is built once and reused
+# until a POST, PATCH or DELETE calls invalidate_drinks_cache().
+_drinks_cache = {}
+_drinks_cache_generation = 0
+
+
+def invalidate_drinks_cache():
+    global _drinks_cache_generation
+    _drinks_cache_generation += 1
+    _drinks_cache.clear()
+
+
+def drinks_response(kind, build):
+    '''Returns the cached JSON response for kind, calling build() to make the
+    body on a miss, and answers 304 when If-None-Match carries its ETag'''
+    cached = _drinks_cache.get(kind)
+    if cached is None:
+        generation = _drinks_cache_generation
+        # Built in full before anything is sent, so any error while reading or
+        # formatting the rows still reaches the caller's abort(500)
+        body = orjson.dumps(build())
+        cached = (body, hashlib.blake2b(body, digest_size=16).hexdigest())
+        # Don't store a body that a concurrent write has already made stale
+        if generation == _drinks_cache_generation:
+            _drinks_cache[kind] = cached
+
+    body, etag = cached
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def short_menu():
+    rows = execute_drink_rows(_DRINK_ROWS).fetchall()
+    number_of_drinks = len(rows)
+
+    # Frontend expects a LIST of drinks (formatted as short() since doesn't need component name details)
+    # Could be many drinks on the menu
+    drinks = [drink_short(*row) for row in rows]
+
+    return {
+        'success': True,
+        'drinks': drinks,
+        'number': number_of_drinks
+    }
+
+
+def long_menu():
+    rows = execute_drink_rows(_DRINK_ROWS)
+
+    # Here Frontend expects a list of drinks but with the long() formatting (which includes
+    # more details on the recipe names of ingredients)
+    drinks = [drink_long(*row) for row in rows]
+
+    return {
+        'success': True,
+        'drinks': drinks
+    }
+
+
 # ROUTES
 '''
     GET /drinks
@@ -33,18 +168,7 @@ CORS(app)
 def get_drinks(payload):
     try:
         # Anyone can get the drinks list, so don't decorate with requires_auth()
-        drinks = Drink.query.all()
-        number_of_drinks = len(drinks)
-
-        # Frontend expects a LIST of drinks (formatted as short() since doesn't need component name details)
-        # Could be many drinks on the menu
-        drinks = [drink.short() for drink in drinks]
-
-        return ({
-            'success': True,
-            'drinks': drinks,
-            'number': number_of_drinks
-        })
+        return drinks_response('short', short_menu)
 
     except:
         abort(500)  # Catchall
@@ -65,16 +189,7 @@ def get_drinks(payload):
 def get_drinks_detail(payload):
     try:                            # Any function that calls the requires_auth will need payload, and maybe other arguments
         # Only Managers and Baristas should see our top-secret recipe
-        drinks = Drink.query.all()
-
-        # Here Frontend expects a list of drinks but with the long() formatting (which includes
-        # more details on the recipe names of ingredients)
-        drinks = [drink.long() for drink in drinks]
-
-        return ({
-            'success': True,
-            'drinks': drinks
-        })
+        return drinks_response('long', long_menu)
 
     except:
         abort(500)  # Catchall
@@ -94,34 +209,24 @@ def get_drinks_detail(payload):
 @requires_auth(permission='post:drinks')
 def post_drink(payload):
     # Get the body data
-    body = request.json
+    body = read_json_body()
 
     # Need to have title and recipe keys in body
-    # if ('title' not in body) or ('recipe' not in body):
-    if not all([x in body for x in ['title', 'recipe']]):
+    if not isinstance(body, dict) or not _DRINK_KEYS <= body.keys():
         abort(422)
 
     # Grab the elements
     drink_title = body['title']
     drink_recipe = body['recipe']
 
-    # Make sure recipe is a list
-    if not isinstance(drink_recipe, list):
+    # Make sure recipe is a list of ingredients in the long format
+    if not recipe_is_valid(drink_recipe):
         abort(422)
 
-    # Check recipe for correct long format.
-    # Each ingredient in the list needs a name, color, and parts
-    for ingredient in drink_recipe:
-        # if ('name' not in ingredient) or ('color' not in ingredient) or ('parts' not in ingredient):
-        if not all([x in ingredient for x in ['name', 'color', 'parts']]):
-            abort(422)
-
-    # Format the drink_recipe as a string for the database (opposite of when we use loads)
-    drink_recipe = json.dumps(drink_recipe)
-
     try:
         drink = Drink(title=drink_title, recipe=drink_recipe)
         drink.insert()
+        invalidate_drinks_cache()
     except Exception as e:
         print(f'Exception in post_drink(): {e}')
         # Understood it all, but can't process for semantic reasons.  Often because drink name needs to be unique.
@@ -149,48 +254,52 @@ def post_drink(payload):
 @app.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth(permission='patch:drinks')
 def edit_drink(payload, id):
-    # Get the drink referred to
-    drink = Drink.query.get(id)
-    if not drink:
-        abort(404)
-
     # Get the body data
-    body = request.json
+    body = read_json_body(on_error=lambda status: reject_drink_body(id, status))
 
     # Here we can update title OR recipe (or both).  Require at least one to be True
-    if not any([x in body for x in ['title', 'recipe']]):
-        abort(422)
+    if not isinstance(body, dict) or _DRINK_KEYS.isdisjoint(body):
+        reject_drink_body(id, 422)
 
+    changes = {}
     if 'title' in body:
-        drink.title = body['title']
+        changes['title'] = body['title']
     if 'recipe' in body:
         drink_recipe = body['recipe']
 
-        # Make sure recipe is a list
-        if not isinstance(drink_recipe, list):
-            abort(422)
+        # Make sure recipe is a list of ingredients in the long format
+        if not recipe_is_valid(drink_recipe):
+            reject_drink_body(id, 422)
 
-        # Check recipe for correct long format.
-        # Each ingredient in the list needs a name, color, and parts
-        for ingredient in drink_recipe:
-            if not all([x in ingredient for x in ['name', 'color', 'parts']]):
-                abort(422)
-
-        # Format the drink_recipe as a string for the database (opposite of when we use loads)
-        drink_recipe = json.dumps(drink_recipe)
-        drink.recipe = drink_recipe
+        # The JSON column serializes the list for the database
+        changes['recipe'] = drink_recipe
 
+    # Update the drink referred to in one statement instead of loading it first
     try:
-        drink.update()
+        updated = Drink.update_by_id(id, changes)
     except Exception as e:
         print(f'Exception in edit_drink(): {e}')
         # Understood it all, but can't process for semantic reasons.
         abort(422)
 
+    if not updated:
+        abort(404)
+    invalidate_drinks_cache()
+
+    # Only read the row back when the body didn't give us every column
+    if len(changes) == 2:
+        drink = drink_long(id, changes['title'], changes['recipe'])
+    else:
+        row = execute_drink_rows(_DRINK_ROW, {'id': id}).first()
+        # Deleted by another request since our UPDATE
+        if row is None:
+            abort(404)
+        drink = drink_long(*row)
+
     return jsonify({
         "success": True,
         # Here contains a list with just the updated drink
-        "drinks": [drink.long()]
+        "drinks": [drink]
     })
 
 
@@ -208,30 +317,49 @@ def edit_drink(payload, id):
 @app.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth(permission='delete:drinks')
 def delete_drink(payload, id):
-    # Get the drink referred to
-    drink = Drink.query.get(id)
-    if not drink:
-        abort(404)
-
+    # Delete the drink referred to in one statement instead of loading it first
     try:
-        drink.delete()
+        deleted = Drink.delete_by_id(id)
     except Exception as e:
         print(f'Exception in delete_drink(): {e}')
         # Understood it all, but can't process for semantic reasons.
         abort(422)
 
+    if not deleted:
+        abort(404)
+    invalidate_drinks_cache()
+
     return jsonify({
         "success": True,
         "delete": id
     })
 
 
-# Error Handling.  Returns tuple of JSON data and integer status code
+# Error Handling.  Returns a JSON response with the matching status code
 
 '''
     error handler should conform to general task above 
 '''
 
+# The error bodies never change, so they are serialized once at import
+_ERROR_MESSAGES = {
+    400: "bad request",
+    401: "unauthorized",
+    403: "forbidden",
+    404: "not found",
+    405: "method not allowed",
+    422: "unprocessable",
+    500: "internal server error"
+}
+_ERROR_BODIES = {
+    status: orjson.dumps({"success": False, "error": status, "message": message})
+    for status, message in _ERROR_MESSAGES.items()
+}
+
+
+def error_response(status):
+    return app.response_class(_ERROR_BODIES[status], status=status, mimetype='application/json')
+
 
 @app.errorhandler(AuthError)
 def auth_error(excpt):
@@ -246,68 +374,40 @@ def auth_error(excpt):
 @app.errorhandler(400)
 def bad_request(error):
     '''Server cannot process request due to client error, such as malformed request'''
-    return jsonify({
-        "success": False,
-        "error": 400,
-        "message": "bad request"
-    }), 400
+    return error_response(400)
 
 
 @app.errorhandler(401)
 def unauthorized(error):
     '''Authentication has not yet been provided'''
-    return jsonify({
-        "success": False,
-        "error": 401,
-        "message": "unauthorized"
-    }), 401
+    return error_response(401)
 
 
 @app.errorhandler(403)
 def forbidden(error):
     '''Server is refusing action, often because user does not have permissions for request'''
-    return jsonify({
-        "success": False,
-        "error": 403,
-        "message": "forbidden"
-    }), 403
+    return error_response(403)
 
 
 @app.errorhandler(404)
 def not_found(error):
     '''Requested resource could not be found on the server'''
-    return jsonify({
-        "success": False,
-        "error": 404,
-        "message": "not found"
-    }), 404
+    return error_response(404)
 
 
 @app.errorhandler(405)
 def method_not_allowed(error):
     '''Request method (i.e. GET or POST) is not allowed for this resource'''
-    return jsonify({
-        "success": False,
-        "error": 405,
-        "message": "method not allowed"
-    }), 405
+    return error_response(405)
 
 
 @app.errorhandler(422)
 def unprocessable(error):
     '''The request was well-formed but unable to be followed due to semantic errors'''
-    return jsonify({
-        "success": False,
-        "error": 422,
-        "message": "unprocessable"
-    }), 422
+    return error_response(422)
 
 
 @app.errorhandler(500)
 def server_error(error):
     '''Catch-all for server error on our end'''
-    return jsonify({
-        "success": False,
-        "error": 500,
-        "message": "internal server error"
-    }), 500
+    return error_response(500)
@@ -1,7 +1,15 @@
-import json
+import sys
+import time
+import hashlib
+import threading
+import orjson
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+import jwt
+from jwt.utils import base64url_decode
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
 from urllib.request import urlopen
 
 
@@ -11,6 +19,23 @@ AUTH0_DOMAIN = 'dev-0occ77jb.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffee_shop'
 
+# Auth0 rotates its signing keys rarely, so the JWKS is fetched once and kept
+# in memory as ready-to-use public keys (keyed by kid) instead of being
+# downloaded and rebuilt on every request
+JWKS_MAX_AGE = 3600
+# An unknown kid triggers a refetch, but never more often than this
+JWKS_MIN_REFRESH = 60
+_JWKS_BY_KID = {}
+_JWKS_FETCHED_AT = 0.0
+_JWKS_LOCK = threading.Lock()
+
+# Verified payloads keyed by a hash of the token, so a client reusing its
+# access token skips the RSA signature check until shortly before it expires
+JWT_CACHE_SIZE = 4096
+JWT_CACHE_EXP_MARGIN = 30
+_JWT_CACHE = OrderedDict()
+_JWT_LOCK = threading.Lock()
+
 # AuthError Exception
 # Secondly, define class AuthError to represent errors originated in this module
 '''
@@ -27,6 +52,55 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# The error details never change, so each dict is built once at import.
+# A fresh AuthError is still raised every time: a shared exception instance
+# would carry its traceback and __context__ from one request into the next.
+_ERR_HEADER_MISSING = {
+    'code': 'authorization_header_missing',
+    'description': 'Authorization header is expected.'
+}
+_ERR_NOT_BEARER = {
+    'code': 'invalid_header',
+    'description': 'Authorization header must start with "Bearer".'
+}
+_ERR_TOKEN_NOT_FOUND = {
+    'code': 'invalid_header',
+    'description': 'Token not found.'
+}
+_ERR_NOT_BEARER_TOKEN = {
+    'code': 'invalid_header',
+    'description': 'Authorization header must be bearer token.'
+}
+_ERR_MALFORMED = {
+    'code': 'invalid_header',
+    'description': 'Authorization malformed.'
+}
+_ERR_UNPARSABLE_TOKEN = {
+    'code': 'invalid_header',
+    'description': 'Unable to parse authentication token.'
+}
+_ERR_KEY_NOT_FOUND = {
+    'code': 'invalid_header',
+    'description': 'Unable to find the appropriate key.'
+}
+_ERR_TOKEN_EXPIRED = {
+    'code': 'token_expired',
+    'description': 'Token expired.'
+}
+_ERR_INVALID_CLAIMS = {
+    'code': 'invalid_claims',
+    'description': 'Incorrect claims. Please, check the audience and issuer.'
+}
+_ERR_PERMISSIONS_MISSING = {
+    'code': 'invalid_claims',
+    'description': 'Permissions not included in JWT.'
+}
+_ERR_PERMISSION_NOT_FOUND = {
+    'code': 'unauthorized',
+    'description': 'Permission not found.'
+}
+
+
 # Auth Header
 # Third, define a function called get_token_auth_header.
 # The app will use this function to read Authorization headers to fetch their access tokens
@@ -46,32 +120,20 @@ def get_token_auth_header():
     """
     auth = request.headers.get('Authorization', None)
     if not auth:
-        raise AuthError({
-            'code': 'authorization_header_missing',
-            'description': 'Authorization header is expected.'
-        }, 401)
+        raise AuthError(_ERR_HEADER_MISSING, 401)
 
-    parts = auth.split()
     # a valid auth has the form of 'bearer {{string}}'
-    if parts[0].lower() != 'bearer':
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must start with "Bearer".'
-        }, 401)
-
-    elif len(parts) == 1:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Token not found.'
-        }, 401)
-
-    elif len(parts) > 2:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must be bearer token.'
-        }, 401)
-
-    token = parts[1]
+    # partition() splits once without building a list of every part
+    scheme, _, token = auth.partition(' ')
+    if scheme.lower() != 'bearer':
+        raise AuthError(_ERR_NOT_BEARER, 401)
+
+    elif not token:
+        raise AuthError(_ERR_TOKEN_NOT_FOUND, 401)
+
+    elif ' ' in token:
+        raise AuthError(_ERR_NOT_BEARER_TOKEN, 401)
+
     return token
 
 
@@ -90,68 +152,128 @@ def get_token_auth_header():
 '''
 
 
-def verify_decode_jwt(token):
-    # Pull the public key and make sure that the jwt was signed by Auth0
+def _rsa_public_key(jwk):
+    """Builds the RSA public key object for a JWK once, so jwt.decode() does
+    not have to parse n and e again for every token
+    """
+    return RSAPublicNumbers(
+        int.from_bytes(base64url_decode(jwk['e']), 'big'),
+        int.from_bytes(base64url_decode(jwk['n']), 'big')
+    ).public_key(default_backend())
+
+
+def _fetch_jwks():
+    """Downloads Auth0's /.well-known/jwks.json and repopulates the key cache
+    """
+    global _JWKS_BY_KID, _JWKS_FETCHED_AT
     # urlopen is a method from url library
     jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
 
     # jwk = json web keys. There are two keys.
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    jwks = orjson.loads(jsonurl.read())
+    # Swap in a whole new dict so concurrent readers never see a half-built cache
+    _JWKS_BY_KID = {
+        # kid = k_id = key_id
+        key['kid']: _rsa_public_key(key)
+        for key in jwks['keys']
+        if key['kty'] == 'RSA'
+    }
+    _JWKS_FETCHED_AT = time.time()
+
+
+def _get_rsa_key(kid):
+    """Returns the cached public key for kid, refetching the JWKS when it is
+    stale or when kid is unknown (Auth0 may have rotated its keys)
+    """
+    if time.time() - _JWKS_FETCHED_AT <= JWKS_MAX_AGE:
+        rsa_key = _JWKS_BY_KID.get(kid)
+        if rsa_key:
+            return rsa_key
+
+    with _JWKS_LOCK:
+        # Another thread may have refreshed the cache while we waited
+        age = time.time() - _JWKS_FETCHED_AT
+        rsa_key = _JWKS_BY_KID.get(kid)
+        if age > JWKS_MAX_AGE or (not rsa_key and age > JWKS_MIN_REFRESH):
+            _fetch_jwks()
+            rsa_key = _JWKS_BY_KID.get(kid)
+    return rsa_key
+
+
+def _get_cached_payload(cache_key):
+    """Returns the payload verified earlier for this token, or None if it was
+    never seen, was evicted, or is about to expire
+    """
+    with _JWT_LOCK:
+        entry = _JWT_CACHE.get(cache_key)
+        if entry is None:
+            return None
+        payload, exp = entry
+        if exp - JWT_CACHE_EXP_MARGIN <= time.time():
+            del _JWT_CACHE[cache_key]
+            return None
+        _JWT_CACHE.move_to_end(cache_key)
+        return payload
+
+
+def _cache_payload(cache_key, payload):
+    """Remembers a verified payload until its exp claim, evicting the least
+    recently used token once the cache is full
+    """
+    exp = payload.get('exp')
+    # Tokens without an expiry are always verified in full
+    if not isinstance(exp, (int, float)):
+        return
+    with _JWT_LOCK:
+        _JWT_CACHE[cache_key] = (payload, exp)
+        _JWT_CACHE.move_to_end(cache_key)
+        if len(_JWT_CACHE) > JWT_CACHE_SIZE:
+            _JWT_CACHE.popitem(last=False)
+
+
+def verify_decode_jwt(token):
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _get_cached_payload(cache_key)
+    if payload is not None:
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError:
+        raise AuthError(_ERR_UNPARSABLE_TOKEN, 400)
     if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
-
-    # There are two keys in here
-    for key in jwks['keys']:
-
-        # Choose the key_id that matches with unverified_header_id
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                # kid = k_id = key_id
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
-        try:
-            # decode jwt from a correct key
-            payload = jwt.decode(
-                token,
-                # public key to decode the token
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-    raise AuthError({
-        'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-    }, 400)
+        raise AuthError(_ERR_MALFORMED, 401)
+
+    # Pull the public key and make sure that the jwt was signed by Auth0.
+    # Choose the key_id that matches with unverified_header_id
+    rsa_key = _get_rsa_key(unverified_header['kid'])
+    if rsa_key is None:
+        raise AuthError(_ERR_KEY_NOT_FOUND, 400)
+
+    try:
+        # decode jwt from a correct key
+        payload = jwt.decode(
+            token,
+            # public key to decode the token
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer='https://' + AUTH0_DOMAIN + '/'
+        )
+
+    except jwt.ExpiredSignatureError:
+        raise AuthError(_ERR_TOKEN_EXPIRED, 401)
+
+    except (jwt.InvalidAudienceError, jwt.InvalidIssuerError, jwt.MissingRequiredClaimError):
+        raise AuthError(_ERR_INVALID_CLAIMS, 401)
+    except Exception:
+        raise AuthError(_ERR_UNPARSABLE_TOKEN, 400)
+
+    # Built once per token (the payload is cached) so each permission
+    # check is a set lookup against interned strings
+    payload['_perm_set'] = frozenset(map(sys.intern, payload.get('permissions', ())))
+    _cache_payload(cache_key, payload)
+    return payload
 
 
 '''
@@ -163,23 +285,17 @@ def verify_decode_jwt(token):
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
-    return true otherwise
+    return the payload otherwise, so calls can be chained
 '''
 
 
 def check_permissions(permission, payload):
     if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+        raise AuthError(_ERR_PERMISSIONS_MISSING, 400)
 
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
-    return True
+    if permission and permission not in payload['_perm_set']:
+        raise AuthError(_ERR_PERMISSION_NOT_FOUND, 403)
+    return payload
 
 
 '''
@@ -202,14 +318,18 @@ def check_permissions(permission, payload):
 
 
 def requires_auth(permission=''):
+    permission = sys.intern(permission)
 
     def requires_auth_decorator(f):
+        # Bound once per decorated view so the wrapper reads closure cells
+        # instead of looking the helpers up in the module globals per call
+        _get_token = get_token_auth_header
+        _verify = verify_decode_jwt
+        _check = check_permissions
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            return f(_check(permission, _verify(_get_token())), *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
@@ -1,7 +1,8 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, JSON
 from flask_sqlalchemy import SQLAlchemy
 import json
+import orjson
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,6 +11,9 @@ database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filenam
 
 db = SQLAlchemy()
 
+# How many prepared statements sqlite3 keeps around per connection
+STATEMENT_CACHE_SIZE = 500
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -17,6 +21,13 @@ setup_db(app)
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        # JSON columns are (de)serialized by the engine, so use orjson there too
+        "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+        "json_deserializer": orjson.loads,
+        # sqlite3 keeps more statements prepared on each connection
+        "connect_args": {"cached_statements": STATEMENT_CACHE_SIZE},
+    }
     db.app = app
     db.init_app(app)
 
@@ -33,6 +44,29 @@ def db_drop_and_create_all():
 def create_all():
     db.create_all()
 
+'''
+drink_short(id, title, recipe) / drink_long(id, title, recipe)
+    build the short and long representations from plain column values
+    so rows selected without loading Drink entities can be formatted too
+    EXAMPLE
+        for row in db.session.execute(select([Drink.id, Drink.title, Drink.recipe])):
+            drink_short(*row)
+'''
+def drink_short(id, title, recipe):
+    short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in recipe]
+    return {
+        'id': id,
+        'title': title,
+        'recipe': short_recipe
+    }
+
+def drink_long(id, title, recipe):
+    return {
+        'id': id,
+        'title': title,
+        'recipe': recipe
+    }
+
 '''
 Drink
 a persistent drink entity, extends the base SQLAlchemy Model
@@ -42,33 +76,23 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
+    # the ingredients blob - a JSON column, so it is read back as a list
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe =  Column(String(180), nullable=False)
+    recipe =  Column(JSON, nullable=False)
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
-        return {
-            'id': self.id,
-            'title': self.title,
-            'recipe': short_recipe           
-        }
+        return drink_short(self.id, self.title, self.recipe)
 
     '''
     long()
         long form representation of the Drink model
     '''
     def long(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'recipe': json.loads(self.recipe)
-        }
+        return drink_long(self.id, self.title, self.recipe)
 
     '''
     insert()
@@ -107,5 +131,26 @@ class Drink(db.Model):
     def update(self):
         db.session.commit()
 
+    '''
+    update_by_id(id, values) / delete_by_id(id)
+        update or delete the row for id with a single statement,
+        without loading the model into the session first
+        returns the number of matched rows (0 when id does not exist)
+        EXAMPLE
+            if not Drink.delete_by_id(id):
+                abort(404)
+    '''
+    @classmethod
+    def update_by_id(cls, id, values):
+        count = cls.query.filter(cls.id == id).update(values, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def delete_by_id(cls, id):
+        count = cls.query.filter(cls.id == id).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
     def __repr__(self):
         return json.dumps(self.short())
\ No newline at end of file